@@ -1,10 +1,61 @@
 from flask import Flask
+from flask.json.provider import DefaultJSONProvider
 from config import Config
 from flask_bootstrap import Bootstrap
+from jinja2 import FileSystemBytecodeCache
+from geocode.query_funcs import build_session
+from geocode.cache import geocoding_cache, response_cache
+from geocode.limiter import attach_bucket_files
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    """Serialize data passed to templates through the `tojson` filter (such as
+    the vetting page's geocoded data) and to `jsonify` with orjson, falling
+    back to the standard library for options or types that orjson does not
+    support."""
+    def dumps(self, obj, **kwargs):
+        options = dict(kwargs)
+        option = orjson.OPT_PASSTHROUGH_DATETIME # Dates are formatted by Flask
+        if options.pop('sort_keys', False):
+            option |= orjson.OPT_SORT_KEYS
+        indent = options.pop('indent', None)
+        separators = options.pop('separators', None)
+        # orjson only writes compact output or output indented by two spaces,
+        #  which are the two layouts Flask asks for
+        if indent == 2 and separators is None:
+            option |= orjson.OPT_INDENT_2
+        elif indent is not None or separators not in (None, (',', ':')):
+            return super().dumps(obj, **kwargs)
+        if options:
+            return super().dumps(obj, **kwargs)
+        try:
+            return orjson.dumps(obj, default=self.default, option=option).decode('utf-8')
+        except TypeError:
+            return super().dumps(obj, **kwargs)
+
+    def loads(self, s, **kwargs):
+        if kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
 
 app = Flask(__name__)
 app.config.from_object(Config)
+if orjson is not None:
+    app.json = OrjsonProvider(app)
 bootstrap = Bootstrap(app)
 app.static_folder = 'static'
+# Share compiled templates between worker processes and restarts
+app.jinja_env.bytecode_cache = FileSystemBytecodeCache()
+# Shared by all geocoding requests so connections to each web tool are reused
+app.geocode_session = build_session()
+geocoding_cache.attach_file(app.config['GEOCODE_CACHE_FILE'])
+response_cache.attach_file(app.config['GEOCODE_CACHE_FILE'])
+# Worker processes share one request rate limit per web geocoding tool
+attach_bucket_files(app.config['RATE_LIMIT_DIR'])
 
 from app import routes
\ No newline at end of file
@@ -43,6 +43,7 @@ class VetSaveForm(FlaskForm):
     submit = SubmitField('Download Results!')
 
 class IndexFinalForm(FlaskForm):
+    token = HiddenField()
     submit = SubmitField('Download Results!')
 
 class InstructionForm(FlaskForm):
@@ -1,20 +1,120 @@
 import json
 import urllib
-from flask import flash, render_template, request, Response, redirect, send_file, session
+from flask import flash, jsonify, render_template, request, Response, redirect, send_file
 from app import app
 from app.forms import GeocodeForm, VetLoadForm, VetSaveForm, IndexFinalForm, InstructionForm
 from geocode import batch_geocode, vet_geocode, utilities
 import time
 import datetime
+from concurrent.futures import ThreadPoolExecutor
 from flask_wtf import FlaskForm
 from flask_wtf.file import FileField, FileRequired
-from io import StringIO, BytesIO
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+import gzip
+import os
+import shutil
 import uuid
-import collections
+from io import BytesIO
 
-# Holds the output data going from index to index_end, by user_id key
+# Holds the output files going from index to index_end, named by user_id
 # This is necessary to avoid global overwriting with concurrent usage
-geocoding_user_variable_buffer = collections.deque(maxlen=20)
+results_dir = app.config['RESULTS_DIR']
+os.makedirs(results_dir, exist_ok=True)
+
+def get_results_path(user_id):
+    return os.path.join(results_dir, f"{user_id}.csv")
+
+def get_gzip_path(user_id):
+    return os.path.join(results_dir, f"{user_id}.csv.gz")
+
+def get_error_path(user_id):
+    return os.path.join(results_dir, f"{user_id}.err")
+
+def gzip_file(path, gzip_path):
+    """Write a gzip-compressed copy of a file, so that it is compressed once
+    rather than on every download."""
+    with open(path, 'rb') as source, open(gzip_path, 'wb') as target:
+        # An empty filename keeps the partial file's name out of the header
+        with gzip.GzipFile(filename='', mode='wb', fileobj=target, compresslevel=6) as compressed:
+            shutil.copyfileobj(source, compressed, 1024 * 1024)
+
+# Geocoding jobs run here so that index() can respond as soon as the upload has
+# been read and validated. Job status is kept on disk so any worker can report it.
+geocoding_executor = ThreadPoolExecutor(max_workers=app.config['GEOCODING_JOBS'])
+
+def run_geocoding_job(user_id, df, geocode_args):
+    """Geocode an uploaded file in the background. The result and a gzipped
+    copy of it are written to partial files and renamed when complete, the
+    CSV last, so the status endpoint never sees an unfinished result. Any
+    error, including unexpected exceptions, is written to the user's error
+    file and the partial files are removed, so the status endpoint always
+    reports the job as done."""
+    partial_path = get_results_path(user_id) + '.part'
+    partial_gzip_path = get_gzip_path(user_id) + '.part'
+    try:
+        outfile, error_type, error = batch_geocode.geocode_to_file(
+            df, outfile=partial_path, session=app.geocode_session, **geocode_args
+        )
+        if error is None:
+            gzip_file(partial_path, partial_gzip_path)
+            os.replace(partial_gzip_path, get_gzip_path(user_id))
+            os.replace(partial_path, get_results_path(user_id))
+            return
+    except Exception as job_error:
+        error_type, error = "Geocoding Error: ", job_error
+    for path in (partial_path, partial_gzip_path):
+        if os.path.exists(path):
+            os.remove(path)
+    with open(get_error_path(user_id), 'w') as error_file:
+        error_file.write(error_type + str(error))
+
+# Signs the user id handed to the download page, so it does not need to be
+# stored in the session
+download_serializer = URLSafeTimedSerializer(app.config['SECRET_KEY'],
+                                             salt='geocode-download')
+
+def load_download_token(token):
+    """Return the user id from a signed download token, or None if the token is
+    invalid or older than the results TTL."""
+    try:
+        return download_serializer.loads(token, max_age=app.config['RESULTS_TTL'])
+    except BadSignature:
+        return None
+
+def send_csv(path_or_file, download_name, gzipped=None):
+    """Send a CSV file as a download. If a gzip-compressed copy is given and
+    the browser accepts gzip, the copy is sent as-is instead; CSV output
+    typically compresses 5-10 times. Both are sent with `send_file()`, so
+    conditional requests and X-Sendfile apply either way."""
+    use_gzip = gzipped is not None and request.accept_encodings['gzip'] > 0
+    response = send_file(gzipped if use_gzip else path_or_file,
+                         download_name=download_name, as_attachment=True,
+                         mimetype='text/csv', conditional=True)
+    if use_gzip:
+        response.headers['Content-Encoding'] = 'gzip'
+    if gzipped is not None:
+        response.vary.add('Accept-Encoding')
+    return response
+
+def dated_file_name(prefix):
+    """Name a downloaded CSV file with a prefix and today's date."""
+    return f"{prefix}_{datetime.datetime.now():%Y_%m_%d}.csv"
+
+# Source suffixes passed to the vetting page; these never change at runtime
+GEOCODING_STRUCT = utilities.get_geocoding_suffixes()
+
+# GeocodeForm checkbox that enables each web geocoding tool
+TOOL_FIELDS = {'GM': 'use_gm', 'OSM': 'use_osm', 'GN': 'use_gn'}
+# GeocodeForm field that fills each argument of `read_flask_input()`
+READ_ARG_FIELDS = {
+    'infile': 'infile', 'encoding': 'encoding', 'address': 'address',
+    'iso': 'iso', 'keygm': 'key', 'geonames': 'geonames'
+}
+# GeocodeForm field that fills each argument of `geocode_to_file()`
+GEOCODE_ARG_FIELDS = {
+    'address': 'address', 'iso': 'iso', 'keygm': 'key', 'geonames': 'geonames',
+    'resultspersource': 'resultsper', 'geo_buffer': 'geo_buffer'
+}
 
 @app.route('/instructions')
 def instructions():
@@ -28,61 +128,69 @@ def index():
     if request.method == 'POST':
         if form.validate_on_submit():
             
-            # Define a user id to identify the download csv in the global deque
+            # Define a user id to identify the download csv in the results directory
             user_id = uuid.uuid4()
-            session['user_id_geocode'] = user_id
-
-            # Define the string of tools to use
-            usetools = list()
-            if form.use_gm.data: usetools.append('GM')
-            if form.use_osm.data: usetools.append('OSM')
-            if form.use_gn.data: usetools.append('GN')
-
-            # Main function which runs the entire geocoding process
-            geocoded_data, error_type, error = batch_geocode.geocode_from_flask(
-                                                    infile=form.infile.data, 
-                                                    encoding=form.encoding.data, 
-                                                    address=form.address.data,
-                                                    iso=form.iso.data,
-                                                    keygm=form.key.data, 
-                                                    geonames=form.geonames.data,
-                                                    usetools=usetools, 
-                                                    resultspersource=form.resultsper.data, 
-                                                    geo_buffer=form.geo_buffer.data
+            utilities.remove_old_files(results_dir, app.config['RESULTS_TTL'])
+
+            # Define the list of tools to use and the geocoding arguments
+            usetools = [tool for tool, field in TOOL_FIELDS.items() if form[field].data]
+            read_args = {arg: form[field].data for arg, field in READ_ARG_FIELDS.items()}
+            geocode_args = {arg: form[field].data for arg, field in GEOCODE_ARG_FIELDS.items()}
+
+            # Read and validate the upload now, while the request still holds it
+            df, error_type, error = batch_geocode.read_flask_input(
+                                                    usetools=usetools,
+                                                    **read_args
             )
 
-            # Add geocoded data to global deque so it is accessible from end page
-            geocoding_user_variable_buffer.append((user_id, geocoded_data))
             if(error is not None):
                 flash(error_type + str(error), 'error')
             else:
-                return render_template('index_end.html', title='Home', form=form)
+                # Geocode in the background; the end page polls `index_status`
+                geocoding_executor.submit(
+                    run_geocoding_job, user_id, df,
+                    dict(geocode_args, usetools=usetools)
+                )
+                end_form = IndexFinalForm(
+                    formdata=None, token=download_serializer.dumps(str(user_id))
+                )
+                return render_template('index_end.html', title='Home', form=end_form)
         else:
             flash('Need to enter all required fields')
     return render_template('index.html', title='Home', form=form)
+
+@app.route('/index_status/<token>')
+def index_status(token):
+    """Report whether the geocoding job for a download token has finished."""
+    user_id = load_download_token(token)
+    if user_id is None:
+        return jsonify(done=True, error='No data found for download, please try reuploading')
+    if os.path.exists(get_results_path(user_id)):
+        return jsonify(done=True, error=None)
+    if os.path.exists(get_error_path(user_id)):
+        with open(get_error_path(user_id)) as error_file:
+            return jsonify(done=True, error=error_file.read())
+    return jsonify(done=False, error=None)
     
 @app.route('/index_end', methods=['GET','POST'])
 def index_end():
     form = IndexFinalForm()
-    back_form = GeocodeForm()
     if form.validate_on_submit():
-        # Pull data from the global deque for download
-        user_id = session['user_id_geocode']
-        file_to_download = None
+        # Pull data from the results directory for download
+        user_id = load_download_token(form.token.data)
         if user_id is None:
             flash('No data found for download, please try reuploading', 'error')
-            return render_template('index.html', title='Home', form=back_form)
-        for file in geocoding_user_variable_buffer:
-            if file[0] == user_id:
-                file_to_download = file[1]
-        if file_to_download is None:
+            return render_template('index.html', title='Home', form=GeocodeForm())
+        file_to_download = get_results_path(user_id)
+        if not os.path.exists(file_to_download):
             flash('No data returned from geocoding, please try reuploading', 'error')
-            return render_template('index.html', title='Home', form=back_form)
-        download_IO = BytesIO(file_to_download.getvalue().encode('utf-8'))
+            return render_template('index.html', title='Home', form=GeocodeForm())
 
-        current_date = datetime.datetime.now()
-        file_out_name = "geocode_results_" + str(current_date.strftime("%Y")) + "_" + str(current_date.strftime("%m")) + "_" + str(current_date.strftime("%d")) + ".csv"
-        return send_file(download_IO, download_name=file_out_name, as_attachment=True)
+        gzip_to_download = get_gzip_path(user_id)
+        if not os.path.exists(gzip_to_download):
+            gzip_to_download = None
+        return send_csv(file_to_download, dated_file_name('geocode_results'),
+                        gzipped=gzip_to_download)
 
 @app.route('/vet', methods=['GET','POST'])
 def vet():
@@ -90,7 +198,7 @@ def vet():
     load_form = VetLoadForm()
     save_form = VetSaveForm()
     # Instantiate an object that will be passed to the page definining source types and source suffixes
-    struct = utilities.get_geocoding_suffixes()
+    struct = GEOCODING_STRUCT
 
     # To do when the first (input data) form is submitted
     if load_form.validate_on_submit():
@@ -123,20 +231,19 @@ def vet():
     # To do when the second (save vetted data) form is submitted
     if save_form.validate_on_submit():
         # Get the transformed JSON data from the page
-        returned_json = urllib.parse.unquote(save_form.json_data.data)
+        returned_json = urllib.parse.unquote_to_bytes(save_form.json_data.data)
         returned_data = utilities.json_to_dataframe(returned_json)
 
         # Prepare data for download through browser 
-        io_output, io_e = utilities.prep_stringio_output(returned_data)
+        download_IO, io_e = utilities.prep_bytesio_output(returned_data)
         if (io_e is not None):
             flash(io_e)
             return render_template('vet.html', title='Vetting', form=save_form, 
                                vet_json=[], show_map=0, result_struct=[])
 
-        download_IO = BytesIO(io_output.getvalue().encode('utf-8'))
-        current_date = datetime.datetime.now()
-        file_out_name = "vetting_results_" + str(current_date.strftime("%Y")) + "_" + str(current_date.strftime("%m")) + "_" + str(current_date.strftime("%d")) + ".csv"
-        return send_file(download_IO, download_name=file_out_name, as_attachment=True)
+        gzipped_IO = BytesIO(gzip.compress(download_IO.getvalue(), compresslevel=6))
+        return send_csv(download_IO, dated_file_name('vetting_results'),
+                        gzipped=gzipped_IO)
 
     # Start application for the first time
     return render_template('vet.html', title='Vetting', form=load_form, 
@@ -1,4 +1,23 @@
 import os 
+import tempfile
+
+# App-owned directory for files that must not be writable by other local users
+instance_dir = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'instance')
 
 class Config(object):
-	SECRET_KEY = os.environ.get('SECRET_KEY') or 'thirty-potatoes-electric'
\ No newline at end of file
+	SECRET_KEY = os.environ.get('SECRET_KEY') or 'thirty-potatoes-electric'
+	# Geocoded files are staged here between the geocoding and download pages
+	RESULTS_DIR = os.environ.get('RESULTS_DIR') or os.path.join(tempfile.gettempdir(), 'batch_geocode_results')
+	# Staged files older than this many seconds are deleted
+	RESULTS_TTL = 24 * 60 * 60
+	# Number of uploaded files that can be geocoded at once by each app process
+	GEOCODING_JOBS = 4
+	# Set when a front-end server (e.g. Apache mod_xsendfile) sends staged files itself
+	USE_X_SENDFILE = os.environ.get('USE_X_SENDFILE', '').lower() in ('1', 'true')
+	# SQLite file where geocoding results are kept between restarts and shared
+	#  between worker processes. This is kept out of the shared temporary
+	#  directory, where another user could create the file first.
+	GEOCODE_CACHE_FILE = os.environ.get('GEOCODE_CACHE_FILE') or os.path.join(instance_dir, 'batch_geocode_cache.sqlite')
+	# Directory of files holding each web geocoding tool's rate limit, so that
+	#  the limit is shared by all worker processes rather than applied per worker
+	RATE_LIMIT_DIR = os.environ.get('RATE_LIMIT_DIR') or os.path.join(instance_dir, 'rate_limits')
\ No newline at end of file
@@ -13,88 +13,227 @@ Written in Python 3.6
 """
 
 import argparse
+import os
 import numpy as np
 import pandas as pd
-from io import StringIO
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from geocode import query_funcs
-from geocode.utilities import read_to_pandas, write_pandas, get_geocoding_suffixes, validate_iso2, check_keys_for_tools, read_and_prep_input, prep_stringio_output, validate_columns
+from geocode.cache import normalize_address, geocoding_cache, response_cache
+from geocode.utilities import read_to_pandas, iter_csv_chunks, write_pandas, write_csv, GEOCODING_SUFFIXES, validate_iso2, check_keys_for_tools, read_and_prep_input, validate_columns, set_input_dtypes
 from tqdm import tqdm
 
-def rearrange_fields(gc_df):
-    """Rearrange the column order of a geocoded dataframe and drop unnecessary 
-    fields."""
-    cols = list(gc_df.columns)
-    # Get all column prefixes (representing source types) and sort
-    #  case-insensitive alphabetically.
+# Number of rows geocoded concurrently. Per-tool request limits are enforced
+#  separately in `query_funcs.PROVIDER_CONCURRENCY`.
+DEFAULT_WORKERS = 8
+# Number of rows read from a CSV file and geocoded before the results are
+#  written out, when running from the command line
+DEFAULT_CHUNKSIZE = 200000
+
+def get_geocoding_columns(result_fields):
+    """Get the ordered output columns for a set of geocoded field names,
+    dropping unnecessary fields. Column prefixes (representing source types)
+    are sorted case-insensitive alphabetically, with 'best' always included."""
     prefixes = sorted(
-        list(set( [c[0:c.index('_')] for c in cols] )),
+        set(c[0:c.index('_')] for c in result_fields),
         key=lambda s: s.lower()
     )
     if 'best' not in prefixes:
         prefixes = ['best'] + prefixes
     # Keep only the following fields from the results of each geocoding tool
-    suffixes = get_geocoding_suffixes()
-    all_cols = [f'{p}_{s}' for p in prefixes for s in suffixes]
-    return gc_df.reindex(labels=all_cols, axis='columns')
-
-
-def geocode_from_flask(infile, keygm, geonames, iso, encoding, address,
-                       usetools, resultspersource, geo_buffer):
-        """Create a function that can be called from flask routes.py that wraps the
-        whole batch_geocode process."""
-
-        # Set all optional arguments to None if they are currently empty
-        # This will cause `geocode_row()` to run using defaults
-        usetools = usetools or None
-        encoding = encoding or None
-        resultspersource = resultspersource or None
-        geo_buffer = geo_buffer or None
-
-        key_error = check_keys_for_tools(keygm, geonames, usetools)
-        if (key_error is not None):
-            return(None, "Key Error: ", key_error)
-
-        # Reading input file
-        df, encoding, read_error = read_and_prep_input(infile, encoding)
-
-        if (read_error is not None):
-            return(None, "Infile Error: ", read_error)
-
-        # Check that columns from web page are in dataset
-        invalid_columns = validate_columns(df, iso, address)
-        if(invalid_columns is not None):
-            return(None, "Invalid column: ", f"{invalid_columns}. If you are sure the columns names are correct, the encoding may be wrong.")
-
-        # Check for invalid iso2s in dataset
-        valid_iso2 = validate_iso2(df[iso])
-        if(valid_iso2 is not None):
-            return(None, "The following iso2s provided were invalid: ", valid_iso2)
-
-        # Initialize progress bar for pandas
-        tqdm.pandas()
-
-        try:
-            # Geocode Rows of Data
-            geocoded_cols = df.progress_apply(
-                lambda row: query_funcs.geocode_row(
-                    address=row[address], iso=row[iso],
-                    gm_key=keygm, gn_key=geonames,
-                    execute_names=usetools, results_per_app=resultspersource,
-                    max_buffer=geo_buffer
-                ),
-                axis=1
-            )
-            geocoded_cols = rearrange_fields(geocoded_cols)
-            df_with_geocoding = pd.concat([df, geocoded_cols], axis=1)            
-        except Exception as e:
-            return(None, "Geocoding Error: ", e)
-
-        # Export Outfile
-        io_output, io_e = prep_stringio_output(df_with_geocoding)
-        if (io_e is not None):
-            return(None, "Error prepping file download: ", io_e)
-
-        return io_output, None, None
+    return [f'{p}_{s}' for p in prefixes for s in GEOCODING_SUFFIXES]
+
+
+@lru_cache(maxsize=None)
+def get_all_geocoding_columns(execute_names, results_per_app):
+    """Get the ordered output columns for every result that the given tools
+    could return, computed once for each combination of settings. Unlike
+    `get_geocoding_columns()`, this includes sources with no results, so
+    separately geocoded chunks share the same columns. `execute_names` must be
+    a tuple."""
+    return tuple(get_geocoding_columns(
+        f'{app}{i+1}_' for app in execute_names for i in range(results_per_app)
+    ))
+
+
+def read_checkpoint(path):
+    """Read the number of rows and bytes of output recorded by
+    `write_checkpoint()`, or (0, 0) if there is no valid checkpoint."""
+    try:
+        with open(path) as checkpoint:
+            rows, size = (int(v) for v in checkpoint.read().split())
+        return (rows, size)
+    except (OSError, ValueError):
+        return (0, 0)
+
+
+def write_checkpoint(path, rows, size):
+    """Record that the first `size` bytes of an output file hold its header
+    and `rows` complete rows. The checkpoint is replaced atomically, so it
+    never describes a partial write."""
+    partial_path = path + '.tmp'
+    with open(partial_path, 'w') as checkpoint:
+        checkpoint.write(f'{rows} {size}\n')
+        checkpoint.flush()
+        os.fsync(checkpoint.fileno())
+    os.replace(partial_path, path)
+
+
+def geocode_dataframe(df, address, iso, keygm, geonames, usetools,
+                      resultspersource, geo_buffer, workers=DEFAULT_WORKERS,
+                      session=None, normalize=False, use_cache=True,
+                      lat_col=None, long_col=None):
+    """Geocode every row of a DataFrame, querying up to `workers` rows at once.
+    The web queries are network-bound, so threads overlap the time spent
+    waiting on each geocoding tool. Addresses that differ only in case or
+    whitespace share a cache entry, so each unique normalized address/ISO pair
+    is only geocoded once. If `normalize` is True, addresses that also differ
+    in accents or spacing around punctuation are geocoded once. If `use_cache`
+    is False, results are neither read from nor saved to the geocoding cache.
+    If `lat_col` and `long_col` are given, rows that already have both
+    coordinates are not geocoded; their coordinates are copied into the
+    'best' fields instead. Returns one column per geocoding field, in the
+    order given by `get_geocoding_columns()` and indexed like `df`."""
+    if iso is not None:
+        # Check each distinct ISO code once, so that e.g. "UG" and "ug" are
+        #  geocoded once; invalid codes become missing
+        checked_isos = {i: query_funcs.check_iso(i) for i in df[iso].unique()}
+        isos = df[iso].map(checked_isos).values
+    else:
+        isos = [None] * df.shape[0]
+    # Normalize each distinct address string once, then map onto all rows
+    normalized = {a: normalize_address(a, loose=normalize) for a in df[address].unique()}
+    pairs = pd.DataFrame({
+        '__address': df[address].values,
+        '__key': df[address].map(normalized).values,
+        '__iso': isos
+    })
+    if lat_col is not None and long_col is not None:
+        # Text such as "unknown" counts as a missing coordinate
+        input_lats = pd.to_numeric(df[lat_col], errors='coerce').to_numpy(
+            dtype='float64', na_value=np.nan
+        )
+        input_longs = pd.to_numeric(df[long_col], errors='coerce').to_numpy(
+            dtype='float64', na_value=np.nan
+        )
+        has_coords = ~(np.isnan(input_lats) | np.isnan(input_longs))
+    else:
+        has_coords = np.zeros(df.shape[0], dtype=bool)
+    unique_pairs = pairs[~has_coords].drop_duplicates(subset=['__key', '__iso'])
+    unique_pairs = unique_pairs.reset_index(drop=True)
+
+    geocode_row = query_funcs.cached_geocode_row if use_cache else query_funcs.geocode_row
+
+    def geocode_one(address_iso):
+        return geocode_row(
+            address=address_iso[0], iso=address_iso[1],
+            gm_key=keygm, gn_key=geonames,
+            execute_names=usetools, results_per_app=resultspersource,
+            max_buffer=geo_buffer, session=session
+        )
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(tqdm(
+            executor.map(geocode_one, zip(unique_pairs['__address'], unique_pairs['__iso'])),
+            total=unique_pairs.shape[0]
+        ))
+    # Each result is a flat dict of scalars, so the geocoded columns can be
+    #  built in a single pass with a fixed column order and dtypes
+    all_cols = get_geocoding_columns(set().union(*results))
+    unique_results = pd.DataFrame.from_records(results, columns=all_cols)
+    numeric_cols = [c for c in all_cols if not c.endswith(('_name', '_type'))]
+    unique_results = unique_results.astype(
+        dict.fromkeys(numeric_cols, 'float64')
+    )
+    unique_results.insert(0, '__key', unique_pairs['__key'])
+    unique_results.insert(1, '__iso', unique_pairs['__iso'])
+    # Join the results for each unique pair back onto every matching row
+    geocoded_cols = pairs.merge(
+        unique_results, on=['__key', '__iso'], how='left'
+    ).drop(columns=['__address', '__key', '__iso'])
+    geocoded_cols.index = df.index
+    if has_coords.any():
+        # Keep the input coordinates rather than any result for the same address
+        geocoded_cols.loc[has_coords, :] = np.nan
+        geocoded_cols.loc[has_coords, 'best_type'] = 'Input coordinates'
+        geocoded_cols.loc[has_coords, 'best_lat'] = input_lats[has_coords]
+        geocoded_cols.loc[has_coords, 'best_long'] = input_longs[has_coords]
+    return geocoded_cols
+
+
+def read_flask_input(infile, keygm, geonames, iso, encoding, address, usetools):
+    """Read the file uploaded through the flask app and check it against the
+    options from the web page, before any geocoding is run. Returns the input
+    DataFrame, or an error type and message."""
+    key_error = check_keys_for_tools(keygm, geonames, usetools or None)
+    if (key_error is not None):
+        return(None, "Key Error: ", key_error)
+
+    # Reading input file
+    df, encoding, read_error = read_and_prep_input(infile, encoding or None)
+
+    if (read_error is not None):
+        return(None, "Infile Error: ", read_error)
+
+    # Check that columns from web page are in dataset
+    invalid_columns = validate_columns(df, iso, address)
+    if(invalid_columns is not None):
+        return(None, "Invalid column: ", f"{invalid_columns}. If you are sure the columns names are correct, the encoding may be wrong.")
+
+    df = set_input_dtypes(df, address, iso)
+
+    # Check for invalid iso2s in dataset
+    valid_iso2 = validate_iso2(df[iso])
+    if(valid_iso2 is not None):
+        return(None, "The following iso2s provided were invalid: ", valid_iso2)
+
+    return df, None, None
+
+
+def geocode_to_file(df, outfile, keygm, geonames, iso, address, usetools,
+                    resultspersource, geo_buffer, session=None,
+                    chunksize=DEFAULT_CHUNKSIZE):
+    """Geocode a validated input DataFrame and write it, with the geocoding
+    results appended, as a UTF-8 CSV to `outfile`. Rows are geocoded and
+    written `chunksize` at a time, so the geocoded copy of the data is never
+    held in memory all at once. Returns the outfile path, or an error type and
+    message."""
+    # Set all optional arguments to None if they are currently empty
+    # This will cause `geocode_row()` to run using defaults
+    usetools = usetools or None
+    resultspersource = resultspersource or None
+    geo_buffer = geo_buffer or None
+    # Every chunk must have the same columns, including sources that returned
+    #  no results for the rows in that chunk
+    all_cols = list(get_all_geocoding_columns(
+        tuple(usetools or query_funcs.DEFAULT_TOOLS),
+        resultspersource or query_funcs.DEFAULT_RESULTS_PER_APP
+    ))
+
+    with open(outfile, 'wb') as out:
+        # An empty input still gets a header row
+        for i, start in enumerate(range(0, max(df.shape[0], 1), chunksize)):
+            chunk = df.iloc[start:start + chunksize]
+            try:
+                # Geocode Rows of Data
+                geocoded_cols = geocode_dataframe(
+                    chunk, address=address, iso=iso, keygm=keygm,
+                    geonames=geonames, usetools=usetools,
+                    resultspersource=resultspersource, geo_buffer=geo_buffer,
+                    session=session
+                )
+                geocoded_cols = geocoded_cols.reindex(columns=all_cols)
+                chunk_with_geocoding = pd.concat([chunk, geocoded_cols], axis=1)
+            except Exception as e:
+                return(None, "Geocoding Error: ", e)
+
+            # Export Outfile
+            try:
+                write_csv(chunk_with_geocoding, out, header=(i == 0))
+            except Exception as e:
+                return(None, "Error prepping file download: ", e)
+
+    return outfile, None, None
 
 
 if __name__ == "__main__":
@@ -147,6 +286,61 @@ if __name__ == "__main__":
              The default is 15 km.
              """
     )
+    parser.add_argument(
+        "-w", "--workers", type=int, default=DEFAULT_WORKERS,
+        help=f"""How many rows should be geocoded at the same time? Requests to
+             each web geocoding tool are also limited separately. The default
+             is {DEFAULT_WORKERS}.
+             """
+    )
+    parser.add_argument(
+        "-n", "--chunksize", type=int, default=DEFAULT_CHUNKSIZE,
+        help=f"""How many rows of a CSV input file should be read and geocoded
+             at a time? Each chunk is appended to a CSV output file as soon as
+             it is geocoded. The default is {DEFAULT_CHUNKSIZE}.
+             """
+    )
+    parser.add_argument(
+        "--latcol", type=str, default=None,
+        help="""Name of an input column of existing latitudes. Rows with both a
+             latitude and a longitude (--longcol) are not geocoded, and their
+             coordinates are copied to the 'best' output fields.
+             """
+    )
+    parser.add_argument(
+        "--longcol", type=str, default=None,
+        help="Name of an input column of existing longitudes; see --latcol."
+    )
+    parser.add_argument(
+        "--resume", action='store_true',
+        help="""Continue an interrupted run: rows already in the CSV output
+             file (as recorded in its .checkpoint file) are kept, any partly
+             written row is removed, and geocoding starts from the next
+             input row.
+             Only used when both files are CSVs.
+             """
+    )
+    parser.add_argument(
+        "--normalize", action='store_true',
+        help="""Geocode addresses that differ only in accents or in spacing
+             around punctuation (e.g. 'Kampala , UG' and 'kampala,ug') once,
+             and share the result between them. Differences in case and
+             whitespace are always ignored.
+             """
+    )
+    parser.add_argument(
+        "--no-cache", action='store_true',
+        help="""Query the web geocoding tools for every unique address, without
+             reading or saving cached results.
+             """
+    )
+    parser.add_argument(
+        "-c", "--cachefile", type=str, default=None,
+        help="""Optional path to a SQLite file where geocoding results are
+             stored between runs. Addresses already in this file are not sent
+             to the web geocoding tools again.
+             """
+    )
 
     # Parse command-line arguments
     c_args = parser.parse_args()
@@ -159,32 +353,88 @@ if __name__ == "__main__":
     print("\n*********************************")
     print("***      BEGIN GEOCODING      ***")
     print("*********************************")
-    print("Reading input file...")
-    df, encoding, errors = read_to_pandas(c_args.infile, c_args.encoding)
-
-    if errors is not None:
-        print("File loading failed: ")
-        raise Exception(errors)
-
-    print(f"Geocoding {df.shape[0]} rows of data...")
-    # Initialize progress bar for pandas
-    tqdm.pandas()
-    # Geocode Rows of Data
-    geocoded_cols = df.progress_apply(
-        lambda row: query_funcs.geocode_row(
-            address=row[c_args.address],
-            iso=None if c_args.iso is None else row[c_args.iso],
-            gm_key=c_args.keygm, gn_key=c_args.geonames,
-            execute_names=execute_apps, results_per_app=c_args.resultspersource,
-            max_buffer=c_args.buffer
-        ),
-        axis=1
+    if c_args.no_cache:
+        response_cache.enabled = False
+    elif c_args.cachefile is not None:
+        geocoding_cache.attach_file(c_args.cachefile)
+        response_cache.attach_file(c_args.cachefile)
+    session = query_funcs.build_session(pool_size=c_args.workers)
+    geocode_args = dict(
+        address=c_args.address, iso=c_args.iso,
+        keygm=c_args.keygm, geonames=c_args.geonames,
+        usetools=execute_apps, resultspersource=c_args.resultspersource,
+        geo_buffer=c_args.buffer, workers=c_args.workers, session=session,
+        normalize=c_args.normalize, use_cache=not c_args.no_cache,
+        lat_col=c_args.latcol, long_col=c_args.longcol
     )
-    geocoded_cols = rearrange_fields(geocoded_cols)
-    df_with_geocoding = pd.concat([df, geocoded_cols], axis=1)
 
-    print("\nExporting output to file...")
-    write_pandas(df=df_with_geocoding, fp=c_args.outfile, encoding=encoding)
+    if (c_args.infile.lower().endswith('.csv') and 
+            c_args.outfile.lower().endswith('.csv')):
+        # Stream CSV files chunk by chunk, so that memory use is bounded by the
+        #  chunk size and results are written as soon as they are available
+        print("Reading input file in chunks...")
+        chunks, encoding = iter_csv_chunks(
+            c_args.infile, c_args.encoding, chunksize=c_args.chunksize,
+            address=c_args.address, iso=c_args.iso
+        )
+        # Every chunk must have the same columns, including sources that
+        #  returned no results for the rows in that chunk
+        all_cols = get_all_geocoding_columns(
+            tuple(execute_apps), c_args.resultspersource
+        )
+        # Rows already written by an interrupted run are skipped, and new rows
+        #  are written after them. The checkpoint records how much of the
+        #  output was complete, so a partly written last row is discarded.
+        checkpoint_path = c_args.outfile + '.checkpoint'
+        done_rows, done_bytes = 0, 0
+        if c_args.resume and os.path.exists(c_args.outfile):
+            done_rows, done_bytes = read_checkpoint(checkpoint_path)
+            if done_bytes > os.path.getsize(c_args.outfile):
+                done_rows, done_bytes = 0, 0
+            print(f"Resuming after {done_rows} rows already in the output file...")
+        if not done_rows and os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+        n_rows = 0
+        with open(c_args.outfile, 'r+b' if done_rows else 'wb') as outfile:
+            outfile.truncate(done_bytes)
+            outfile.seek(done_bytes)
+            for chunk in chunks:
+                if n_rows + chunk.shape[0] <= done_rows:
+                    n_rows += chunk.shape[0]
+                    continue
+                chunk = chunk.iloc[max(done_rows - n_rows, 0):]
+                n_rows = max(n_rows, done_rows)
+                print(f"Geocoding rows {n_rows + 1} to {n_rows + chunk.shape[0]}...")
+                geocoded_cols = geocode_dataframe(chunk, **geocode_args)
+                geocoded_cols = geocoded_cols.reindex(columns=list(all_cols))
+                write_csv(
+                    pd.concat([chunk, geocoded_cols], axis=1), outfile,
+                    encoding=encoding, header=(n_rows == 0)
+                )
+                # Keep the output file complete up to this chunk in case the
+                #  run is interrupted
+                outfile.flush()
+                os.fsync(outfile.fileno())
+                n_rows += chunk.shape[0]
+                write_checkpoint(checkpoint_path, n_rows, outfile.tell())
+    else:
+        print("Reading input file...")
+        df, encoding, errors = read_to_pandas(
+            c_args.infile, c_args.encoding, address=c_args.address, iso=c_args.iso
+        )
+
+        if errors is not None:
+            print("File loading failed: ")
+            raise Exception(errors)
+
+        print(f"Geocoding {df.shape[0]} rows of data...")
+        # Geocode Rows of Data
+        geocoded_cols = geocode_dataframe(df, **geocode_args)
+        df_with_geocoding = pd.concat([df, geocoded_cols], axis=1)
+
+        print("\nExporting output to file...")
+        write_pandas(df=df_with_geocoding, fp=c_args.outfile, encoding=encoding)
 
+    session.close()
     print(f"Your output file is now ready to view at {c_args.outfile} !")
     print("\nGEOCODING COMPLETE")
@@ -0,0 +1,186 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+This module defines a process-wide cache of geocoding results, so that
+repeated address/ISO pairs (within one input file or across uploads) are only
+sent to the web geocoding tools once. Results can also be persisted to a
+SQLite file so that they survive restarts and are shared between processes.
+
+Written in Python 3.6
+"""
+import copy
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+
+# Whitespace around punctuation, e.g. "Kampala , UG"
+PUNCTUATION_SPACING = re.compile(r'\s*([,;:./()-])\s*')
+
+
+def normalize_address(address, loose=False):
+    """Normalize address text for use in a cache key: apply Unicode NFKC
+    normalization (so e.g. full-width and composed characters match their
+    usual forms), strip, lowercase, and collapse internal whitespace. If
+    `loose` is True, also remove accents and any whitespace around
+    punctuation, so that e.g. "  Kampala , UG" and "kampala,ug" are treated
+    as the same address."""
+    address = unicodedata.normalize('NFKC', str(address))
+    address = ' '.join(address.split()).lower()
+    if loose:
+        address = unicodedata.normalize('NFKD', address)
+        address = ''.join(c for c in address if not unicodedata.combining(c))
+        address = PUNCTUATION_SPACING.sub(r'\1', address)
+    return address
+
+
+class GeocodingCache(object):
+    """A thread-safe least-recently-used cache with a time-to-live, mapping
+    geocoding query parameters to the result dictionaries returned by
+    `query_funcs.geocode_row()`. If a file is attached with `attach_file()`,
+    results are also stored on disk and looked up there on a memory miss.
+
+    Attributes:
+        maxsize (int): Maximum number of results held in memory before the
+            least recently used result is evicted.
+        ttl (numeric): Number of seconds a result remains valid in memory.
+        disk_ttl (numeric): Number of seconds a result remains valid on disk.
+        path (str): Path to the SQLite file used for persistence, if any.
+        table (str): Name of the table in the SQLite file, so that several
+            caches can share one file.
+        enabled (bool): If False, nothing is read from or saved to the cache.
+        binary (bool): If True, values are raw bytes, stored on disk as-is;
+            otherwise they are flat dictionaries of scalars, stored as JSON.
+            Values are never pickled, so a planted cache file cannot run
+            code when it is read.
+    """
+    def __init__(self, maxsize=100000, ttl=86400, disk_ttl=30*86400,
+                 table='results', binary=False):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.disk_ttl = disk_ttl
+        self.path = None
+        self.table = table
+        self.enabled = True
+        self.binary = binary
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+
+    @staticmethod
+    def make_key(address, iso=None, gm_key=None, gn_key=None,
+                 execute_names=None, results_per_app=None, max_buffer=None):
+        """Build a cache key from all parameters that affect the geocoding
+        results. The key is a plain tuple, hashed by Python's built-in string
+        hash rather than a hashlib digest. API keys are included so that
+        results fetched with an invalid key are never served to other users."""
+        tools = tuple(sorted(execute_names)) if execute_names else ()
+        return (
+            normalize_address(address), str(iso).lower(), tools,
+            results_per_app, max_buffer, gm_key, gn_key
+        )
+
+    @staticmethod
+    def _disk_key(key):
+        """Stable digest of a key for storage on disk. Hashing keeps API keys
+        out of the cache file."""
+        return hashlib.blake2b(repr(key).encode('utf-8'), digest_size=16).hexdigest()
+
+    def attach_file(self, path):
+        """Persist results to a SQLite file at `path`, creating it if needed."""
+        directory = os.path.dirname(os.path.abspath(path))
+        # Only the app's own user should be able to write the cache file
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        with self._lock:
+            self._db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute(
+                f'CREATE TABLE IF NOT EXISTS {self.table} '
+                '(key TEXT PRIMARY KEY, stored_at REAL, value BLOB)'
+            )
+            self._db.commit()
+            self.path = path
+
+    def _get_from_disk(self, key):
+        row = self._db.execute(
+            f'SELECT stored_at, value FROM {self.table} WHERE key = ?',
+            (self._disk_key(key),)
+        ).fetchone()
+        if row is None or time.time() - row[0] > self.disk_ttl:
+            return None
+        value = row[1]
+        if self.binary:
+            return value if isinstance(value, bytes) else None
+        try:
+            return json.loads(value)
+        except (TypeError, ValueError):
+            # Not written by this version of the module; treat as a miss
+            return None
+
+    def get(self, key):
+        """Return the cached result for a key, or None if it is missing or
+        has expired."""
+        if not self.enabled:
+            return None
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                stored_at, value = item
+                if time.time() - stored_at <= self.ttl:
+                    self._data.move_to_end(key)
+                    return copy.copy(value)
+                del self._data[key]
+            if self._db is None:
+                return None
+            value = self._get_from_disk(key)
+            if value is None:
+                return None
+            self._set_in_memory(key, value)
+            return copy.copy(value)
+
+    def _set_in_memory(self, key, value):
+        self._data[key] = (time.time(), copy.copy(value))
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def set(self, key, value):
+        """Store a result, evicting the least recently used result from memory
+        if the cache is full."""
+        if not self.enabled:
+            return
+        with self._lock:
+            self._set_in_memory(key, value)
+            if self._db is not None:
+                self._db.execute(
+                    f'INSERT OR REPLACE INTO {self.table} VALUES (?, ?, ?)',
+                    (self._disk_key(key), time.time(),
+                     value if self.binary else json.dumps(value))
+                )
+                self._db.commit()
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            if self._db is not None:
+                self._db.execute(f'DELETE FROM {self.table}')
+                self._db.commit()
+
+
+# Shared by all geocoding requests handled in this process. A result with
+#  several locations takes a few KB, so this holds tens of MB at most; older
+#  results are still found in the SQLite file, if one is attached. Table names
+#  differ from earlier versions, whose values were pickled and are not read.
+geocoding_cache = GeocodingCache(maxsize=10000, table='result_json')
+# Raw response bodies from each web geocoding tool, keyed by the request URL and
+#  parameters. This lets runs with different tools or settings reuse responses.
+#  Bodies are several KB each, so far fewer are held in memory than results;
+#  older responses are still found in the SQLite file, if one is attached.
+response_cache = GeocodingCache(maxsize=5000, table='response_bodies',
+                                binary=True)
@@ -0,0 +1,108 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+This module defines token buckets that limit how many requests per second are
+sent to each web geocoding tool, so that concurrent rows can query every tool
+at its own published rate limit without exceeding it. By default a bucket
+only limits the process it lives in; once attached to a file, it is shared by
+every process that attaches the same file (e.g. all gunicorn workers).
+
+Written in Python 3.6
+"""
+import os
+import threading
+import time
+try:
+    import fcntl
+except ImportError:
+    # File locks are unavailable on Windows; buckets then stay per-process
+    fcntl = None
+
+
+class TokenBucket(object):
+    """A thread-safe token bucket. Tokens are added continuously at `rate`
+    per second, up to `burst` tokens; each request takes one token, waiting
+    until one is available if the bucket is empty.
+
+    The bucket is stored as the time at which it will next be full, so that
+    its whole state is one number that can be kept in a file and updated under
+    a file lock by several processes.
+
+    Attributes:
+        rate (numeric): Sustained number of requests allowed per second.
+        burst (int): Maximum number of requests that can be sent at once after
+            the bucket has been idle.
+        path (str): Path to the file holding the bucket's state, if it is
+            shared between processes.
+    """
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.path = None
+        self._full_at = 0.0
+        self._lock = threading.Lock()
+
+    def attach_file(self, path):
+        """Share this bucket with every process that attaches the same file,
+        creating it if needed. Has no effect where file locks are
+        unavailable."""
+        if fcntl is None:
+            return
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        self.path = path
+
+    def _reserve(self, full_at, now):
+        """Take one token from a bucket that is next full at `full_at`.
+        Returns the new full time and how long the caller must wait for the
+        token; if the bucket is empty, the caller waits until it would have
+        refilled."""
+        full_at = max(full_at, now) + 1 / self.rate
+        return full_at, max(full_at - now - self.burst / self.rate, 0)
+
+    def _reserve_in_file(self):
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                full_at = float(os.read(fd, 64) or 0)
+            except ValueError:
+                full_at = 0.0
+            full_at, wait = self._reserve(full_at, time.time())
+            os.lseek(fd, 0, os.SEEK_SET)
+            os.ftruncate(fd, 0)
+            os.write(fd, repr(full_at).encode('ascii'))
+            return wait
+        finally:
+            # Closing the file also releases the lock
+            os.close(fd)
+
+    def acquire(self):
+        """Take one token, sleeping until it is available. The token is
+        reserved under the lock and the sleep happens outside it, so waiting
+        threads do not hold up one another's reservations."""
+        with self._lock:
+            if self.path is not None:
+                wait = self._reserve_in_file()
+            else:
+                self._full_at, wait = self._reserve(self._full_at, time.time())
+        if wait > 0:
+            time.sleep(wait)
+
+
+# Requests per second and burst size allowed by each web geocoding tool's usage
+#  policy. Nominatim allows at most one request per second. These limits apply
+#  to each process unless the buckets are shared with `attach_bucket_files()`.
+PROVIDER_RATE_LIMITS = {'GM': (45, 10), 'OSM': (1, 1), 'GN': (1, 1)}
+provider_buckets = {
+    name: TokenBucket(rate, burst)
+    for name, (rate, burst) in PROVIDER_RATE_LIMITS.items()
+}
+
+
+def attach_bucket_files(directory):
+    """Share every tool's token bucket between all processes that attach the
+    same directory, so that the rate limits hold for the app as a whole
+    rather than for each worker process."""
+    for name, bucket in provider_buckets.items():
+        bucket.attach_file(os.path.join(directory, f'{name}.ratelimit'))
@@ -10,35 +10,139 @@ using the Google Maps, OpenStreetMaps, GeoNames, and FuzzyG APIs.
 Written in Python 3.6
 """
 
-import json
+import math
 import numpy as np
 import pandas as pd
 import requests
-import xmltodict
-from haversine import haversine
-from collections import namedtuple, OrderedDict
+import threading
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from itertools import islice
+from xml.etree import ElementTree
+from geocode.cache import geocoding_cache, response_cache
+from geocode.limiter import provider_buckets
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+# Web geocoding tools queried, and results kept from each, unless specified
+DEFAULT_TOOLS = ("GM", "OSM", "GN", "FG")
+DEFAULT_RESULTS_PER_APP = 2
+
+# Maximum number of simultaneous requests sent to each web geocoding tool by
+#  this process when rows are geocoded concurrently. Nominatim's usage policy
+#  allows only one. Request rates are limited separately by the token buckets
+#  in `geocode.limiter`, which the web app shares between worker processes.
+PROVIDER_CONCURRENCY = {'GM': 10, 'OSM': 1, 'GN': 4, 'FG': 4}
+provider_semaphores = {
+    name: threading.BoundedSemaphore(limit)
+    for name, limit in PROVIDER_CONCURRENCY.items()
+}
+# Runs the queries to each web geocoding tool for a row concurrently. It is
+#  sized so that every tool can use its full request limit at once.
+provider_executor = ThreadPoolExecutor(max_workers=sum(PROVIDER_CONCURRENCY.values()))
 
 
 ################################################################################
 ## HELPER FUNCTIONS
 ################################################################################
 
+def build_session(pool_size=16):
+    """Create a `requests.Session` for the web geocoding tools. Reusing one
+    session keeps connections to each service alive between queries instead of
+    repeating the TCP/TLS handshake, and retries rate-limited (429) and
+    transient server errors with exponential backoff. One connection pool is
+    kept per service, each large enough for that service's full request limit
+    in `PROVIDER_CONCURRENCY` so that no connection is opened and discarded."""
+    retries = Retry(total=5, backoff_factor=0.5,
+                    status_forcelist=[429, 500, 502, 503, 504])
+    pool_maxsize = max(pool_size, *PROVIDER_CONCURRENCY.values())
+    adapter = HTTPAdapter(pool_connections=len(PROVIDER_CONCURRENCY),
+                          pool_maxsize=pool_maxsize, max_retries=retries)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+# Used by web interfaces that are not passed a session, e.g. when calling
+#  `geocode_row()` directly
+default_session = build_session()
+# Seconds to wait to connect to, or for a response from, a web geocoding tool
+REQUEST_TIMEOUT = 30
+
+
+# IUGG mean Earth radius in kilometers
+EARTH_RADIUS_KM = 6371.0088
+
+
+def haversine_km(a_long, a_lat, b_long, b_lat):
+    """Great-circle distance in kilometers between matching elements of four
+    equal-length arrays of coordinates."""
+    a_long, a_lat, b_long, b_lat = map(np.radians, (a_long, a_lat, b_long, b_lat))
+    h = (np.sin((b_lat - a_lat) / 2) ** 2
+         + np.cos(a_lat) * np.cos(b_lat) * np.sin((b_long - a_long) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(h))
+
+
+def haversine_km_scalar(a_long, a_lat, b_long, b_lat):
+    """Great-circle distance in kilometers between two points. For single
+    points, the `math` module avoids the overhead of NumPy's array dispatch."""
+    a_long, a_lat, b_long, b_lat = map(math.radians, (a_long, a_lat, b_long, b_lat))
+    h = (math.sin((b_lat - a_lat) / 2) ** 2
+         + math.cos(a_lat) * math.cos(b_lat) * math.sin((b_long - a_long) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(h))
+
+
 def check_iso(iso):
     """The geocoding services all take an ISO-2 code. If the passed value does
     not match the formatting for an ISO-2 code, pass None as the ISO code 
     instead."""
-    if type(iso) is str and len(iso)==2:
+    if isinstance(iso, str) and len(iso)==2:
         return iso.lower()
     else:
         return None
 
 
+def run_geocoding_manager(address, iso=None, gm_key=None, gn_key=None,
+                          execute_names=None, results_per_app=None,
+                          max_buffer=None, session=None):
+    """Instantiate a WebGeocodingManager object for a single address/ISO row
+    and run the entire geocoding process on it. Returns the manager, so that
+    callers can fetch the results and check whether every query succeeded.
+    Takes the same arguments as `geocode_row()`."""
+    # Define a list of arguments to be passed to a WebGeocodingManager object
+    args_dict = {
+        'location_text' : address,
+        'iso' : check_iso(iso)
+    }
+    # For all other arguments, use the class defaults if they are not passed to
+    #  this function
+    if gm_key is not None: args_dict['gm_key'] = gm_key
+    if gn_key is not None: args_dict['gn_key'] = gn_key
+    if execute_names is not None: args_dict['execute'] = execute_names
+    if results_per_app is not None: args_dict['results_per_app'] = results_per_app
+    if max_buffer is not None: args_dict['max_buffer'] = max_buffer
+    if session is not None: args_dict['session'] = session
+
+    # Run the geocoding manager for this location
+    webgm = WebGeocodingManager(**args_dict)
+    webgm.create_web_interfaces()
+    webgm.geocode()
+    webgm.vet()
+    return webgm
+
+
 def geocode_row(address, iso=None, gm_key=None, gn_key=None, execute_names=None,
-                results_per_app=None, max_buffer=None, track_progress=True):
+                results_per_app=None, max_buffer=None, session=None):
     """This function geocodes a single address/ISO row from the input dataset.
-    It instantiates a WebGeocodingManager object and runs the entire geocoding
-    process using the WebGeocodingManager API. It then fetches and returns the 
-    geocoding results as a pandas Series.
+    It runs the entire geocoding process using the WebGeocodingManager API, 
+    then fetches and returns the geocoding results as a flat dictionary of
+    field names to scalar values.
 
     Arguments: All arguments except for `address` are optional and will revert
     to the defaults for the WebGeocodingManager class.
@@ -55,31 +159,40 @@ def geocode_row(address, iso=None, gm_key=None, gn_key=None, execute_names=None,
             from each geocoding application?
         max_buffer (numeric, optional): The maximum acceptable "buffer size" 
             (bounding box diagonal distance) for an individual result to take.
-        track_progress (boolean, default True): If true，the function writes a 
-            dot (.) to output each time this function runs.
+        session (requests.Session, optional): Session used for all web
+            queries, so that connections can be reused across rows.
     """
-    # Define a list of arguments to be passed to a WebGeocodingManager object
-    args_dict = {
-        'location_text' : address,
-        'iso' : check_iso(iso)
-    }
-    # For all other arguments, use the class defaults if they are not passed to
-    #  this function
-    if gm_key is not None: args_dict['gm_key'] = gm_key
-    if gn_key is not None: args_dict['gn_key'] = gn_key
-    if execute_names is not None: args_dict['execute'] = execute_names
-    if results_per_app is not None: args_dict['results_per_app'] = results_per_app
-    if max_buffer is not None: args_dict['max_buffer'] = max_buffer
-
-    # Run the geocoding manager for this location
-    webgm = WebGeocodingManager(**args_dict)
-    webgm.create_web_interfaces()
-    webgm.geocode()
-    webgm.vet()
-    geocoding_results = webgm.get_results_as_series()
-    if track_progress:
-        # Track progress using dots
-        print('.', end='', flush=True)
+    webgm = run_geocoding_manager(
+        address=address, iso=iso, gm_key=gm_key, gn_key=gn_key,
+        execute_names=execute_names, results_per_app=results_per_app,
+        max_buffer=max_buffer, session=session
+    )
+    return webgm.get_results_as_dict()
+
+
+def cached_geocode_row(address, iso=None, gm_key=None, gn_key=None,
+                       execute_names=None, results_per_app=None,
+                       max_buffer=None, session=None):
+    """Wrapper around `geocode_row()` that returns a cached result when the
+    same normalized address has already been geocoded with the same settings,
+    skipping all web queries. Takes the same arguments as `geocode_row()`.
+    Results are only cached if every web query succeeded, so that e.g. an
+    exceeded quota is retried on a later run instead of being served as an
+    empty result."""
+    cache_key = geocoding_cache.make_key(
+        address, check_iso(iso), gm_key, gn_key, execute_names,
+        results_per_app, max_buffer
+    )
+    geocoding_results = geocoding_cache.get(cache_key)
+    if geocoding_results is None:
+        webgm = run_geocoding_manager(
+            address=address, iso=iso, gm_key=gm_key, gn_key=gn_key,
+            execute_names=execute_names, results_per_app=results_per_app,
+            max_buffer=max_buffer, session=session
+        )
+        geocoding_results = webgm.get_results_as_dict()
+        if webgm.all_queries_succeeded():
+            geocoding_cache.set(cache_key, geocoding_results)
     return geocoding_results
 
 
@@ -90,8 +203,10 @@ def geocode_row(address, iso=None, gm_key=None, gn_key=None, execute_names=None,
 class WebGeocodingManager(object):
     """This class manages the entire geocoding process for a single location.
     """
-    def __init__(self, location_text, iso=None, execute=["GM","OSM","GN","FG"], 
-                 gm_key=None, gn_key=None, results_per_app=2, max_buffer=15):
+    def __init__(self, location_text, iso=None, execute=list(DEFAULT_TOOLS), 
+                 gm_key=None, gn_key=None,
+                 results_per_app=DEFAULT_RESULTS_PER_APP, max_buffer=15,
+                 session=None):
         """This class manages the web geocoding process for a single location.
         It takes location text, and ISO-2 code, a list of web geocoding tools to
         execute, and keys for the two services that require them. The web
@@ -131,6 +246,8 @@ class WebGeocodingManager(object):
                 geocoding application?
             max_buffer (numeric): The maximum acceptable "buffer size" (bounding
                 box diagonal distance) for an individual result to take.
+            session (requests.Session): Session shared by all web interfaces.
+                If None, each query uses a new connection.
             location_results (dict): Dictionary of all GeocodedLocation objects
                 returned from geocoding. This list is populated in the `geocode`
                 method and is then trimmed in the `vet` method.
@@ -143,68 +260,94 @@ class WebGeocodingManager(object):
         self.gn_key = gn_key
         self.results_per_app = results_per_app
         self.max_buffer = max_buffer
+        self.session = session
         self.location_results = dict()
 
     def create_web_interfaces(self):
         """Given a list of apps to execute, instantiate various web interfaces.
+        Google Maps and GeoNames are skipped if no key was passed for them,
+        since every query they receive would fail.
         """
-        if "GM" in self.execute_names:
+        if "GM" in self.execute_names and self.gm_key:
             self.execute_apps['GM'] = GMInterface(
                 location_text = self.location_text,
                 iso           = self.iso,
                 key           = self.gm_key,
-                n_results     = self.results_per_app
+                n_results     = self.results_per_app,
+                session       = self.session
             )
         if "OSM" in self.execute_names:
             self.execute_apps['OSM'] = OSMInterface(
                 location_text = self.location_text,
                 iso           = self.iso,
-                n_results     = self.results_per_app
+                n_results     = self.results_per_app,
+                session       = self.session
             )
-        if "GN" in self.execute_names:
+        if "GN" in self.execute_names and self.gn_key:
             self.execute_apps['GN'] = GNInterface(
                 location_text = self.location_text,
                 iso           = self.iso,
                 key           = self.gn_key,
-                n_results     = self.results_per_app
+                n_results     = self.results_per_app,
+                session       = self.session
             )
         if "FG" in self.execute_names:
             self.execute_apps["FG"] = FuzzyGInterface(
                 location_text = self.location_text,
                 iso           = self.iso,
-                n_results     = self.results_per_app
+                n_results     = self.results_per_app,
+                session       = self.session
             )
 
+    @staticmethod
+    def query_interface(interface):
+        """Run the full query for one web interface and return its locations."""
+        # Build the API query
+        interface.build_query()
+        # Execute the API query
+        interface.execute_query()
+        # Compile geocoding results as GeocodedLocation objects
+        interface.populate_locs()
+        return interface.return_locs()
+
     def geocode(self):
-        """Execute all web queries and build location objects from them.
+        """Execute all web queries and build location objects from them. The
+        web tools are queried at the same time, so each row waits only as long
+        as its slowest tool rather than the sum of all of them.
         """
-        for app_class in self.execute_apps.keys():
-            # Build the API query
-            self.execute_apps[app_class].build_query()
-            # Execute the API query
-            self.execute_apps[app_class].execute_query()
-            # Compile geocoding results as GeocodedLocation objects
-            self.execute_apps[app_class].populate_locs()
+        futures = [
+            (app_class, provider_executor.submit(self.query_interface, interface))
+            for app_class, interface in self.execute_apps.items()
+        ]
+        for app_class, future in futures:
             # Collect top 2 GeocodedLocations from each web interface
-            loc_res = self.execute_apps[app_class].return_locs()
-            for i in range(len(loc_res)):
-                self.location_results[f'{app_class}{i+1}'] = loc_res[i]
+            loc_res = future.result()
+            for i, location in enumerate(loc_res, start=1):
+                self.location_results[f'{app_class}{i}'] = location
 
     def vet(self):
         """Execute some vetting of location outputs."""
         # This object will store points from all valid results
         combined_pts = list()
         num_valid  = 0
+        found = [(k, loc_res) for k, loc_res in self.location_results.items()
+                 if loc_res is not None]
+        # Calculate the buffer size of every location result at once
+        boxes = np.array(
+            [loc_res.bound_box for _, loc_res in found], dtype=float
+        ).reshape(-1, 4)
+        buffers = haversine_km(boxes[:, 0], boxes[:, 1], boxes[:, 2], boxes[:, 3])
         # Vetting for individual location results based on buffer size
-        for k,loc_res in self.location_results.items():
-            if loc_res is not None:
-                if loc_res.get_diag_buffer() <= self.max_buffer:
-                    # If the location is valid, add its points to the combined list
-                    combined_pts = combined_pts + loc_res.get_points_list()
-                    num_valid = num_valid + 1
-                else:                    
-                    # Remove the location result if the buffer is too large
-                    self.location_results[k] = None
+        for (k, loc_res), buffer_dist, is_valid in zip(
+                found, buffers, buffers <= self.max_buffer):
+            loc_res.diag_buffer = float(buffer_dist)
+            if is_valid:
+                # If the location is valid, add its points to the combined list
+                combined_pts.extend(loc_res.get_points_list())
+                num_valid = num_valid + 1
+            else:
+                # Remove the location result if the buffer is too large
+                self.location_results[k] = None
 
         # Check to see if a best result can be generated from the bounding box
         #  of all valid location results combined
@@ -218,51 +361,72 @@ class WebGeocodingManager(object):
             if combined_location.get_diag_buffer() <= self.max_buffer:
                 self.location_results['best'] = combined_location
 
+    def all_queries_succeeded(self):
+        """Whether every web interface received a usable response, rather than
+        e.g. a quota or key error."""
+        return all(
+            interface.succeeded for interface in self.execute_apps.values()
+        )
+
+    def get_results_as_dict(self):
+        """Pass back all location results as a single flat dictionary, with
+        each field name prefixed by the key of its location result."""
+        results_to_return = dict()
+        for k, loc_res in self.location_results.items():
+            if loc_res is not None:
+                results_to_return.update(
+                    zip(prefixed_field_names(k), loc_res.get_attribute_values())
+                )
+        return results_to_return
+
     def get_results_as_series(self):
         """Systematically pass back the location result as a pandas Series."""
-        # Initialize empty results
-        results_to_return = [ pd.Series([], dtype='Float64') ]
-        valid_keys = [k for k in self.location_results.keys() 
-                        if self.location_results[k] is not None]
-        # Get a series representation of each non-empty location result, 
-        #  changing names to match the key prefix
-        for k in valid_keys:
-            loc_series = self.location_results[k].get_attributes_as_series()
-            loc_series.index = [f'{k}_{c}' for c in list(loc_series.index)]
-            results_to_return.append( loc_series )
-        # Combine all results into a single series
-        return( pd.concat(results_to_return, axis=0) )
+        return pd.Series(self.get_results_as_dict(), dtype=object)
+
+
+BoundingBox = namedtuple('BoundingBox', ['min_x', 'min_y', 'max_x', 'max_y'])
+
+# Fields returned for each location result, in the order of
+#  `GeocodedLocation.get_attribute_values()`
+LOCATION_FIELDS = ('name', 'type', 'long', 'lat', 'bb_n', 'bb_s', 'bb_e', 'bb_w',
+                   'buffer')
+
+
+@lru_cache(maxsize=None)
+def prefixed_field_names(prefix):
+    """Output field names for a location result key such as 'GM1' or 'best',
+    built once per key rather than once per row."""
+    return tuple(f'{prefix}_{field}' for field in LOCATION_FIELDS)
 
 
 class GeocodedLocation(object):
+    # One instance is created per result, so skip the per-instance __dict__
+    __slots__ = ('points_list', 'points', 'address_name', 'location_type',
+                 'source', 'bound_box', 'diag_buffer')
 
     def __init__(self, points_list, address_name='', location_type='', source=''):
         """Take a list of points and instantiate a new location."""
         self.points_list   = points_list 
+        self.points        = np.asarray(points_list, dtype=np.float64).reshape(-1, 2)
         self.address_name  = address_name
         self.location_type = location_type
         self.source        = source
         self.bound_box     = self.get_bounding_box()
+        self.diag_buffer   = None # Calculated once in `get_diag_buffer()`
 
     @staticmethod
     def calc_haversine_distance(a_long, a_lat, b_long, b_lat):
-        pt_a = (a_lat, a_long)
-        pt_b = (b_lat, b_long)
-        dist = haversine(pt_a, pt_b)
-        return dist
+        return haversine_km_scalar(a_long, a_lat, b_long, b_lat)
 
     def get_centroid(self):
-        avg_long = np.nanmean([pt[0] for pt in self.points_list])
-        avg_lat = np.nanmean([pt[1] for pt in self.points_list])
-        return(avg_long, avg_lat)
+        avg_long, avg_lat = np.nanmean(self.points, axis=0)
+        return(float(avg_long), float(avg_lat))
 
     def get_bounding_box(self):
-        BoundingBox = namedtuple('BoundingBox', ['min_x', 'min_y', 'max_x', 'max_y'])
-        min_long = min(pt[0] for pt in self.points_list)
-        min_lat = min(pt[1] for pt in self.points_list)
-        max_long = max(pt[0] for pt in self.points_list)
-        max_lat = max(pt[1] for pt in self.points_list)
-        bound_box = BoundingBox(min_long, min_lat, max_long, max_lat)
+        min_long, min_lat = np.nanmin(self.points, axis=0)
+        max_long, max_lat = np.nanmax(self.points, axis=0)
+        bound_box = BoundingBox(float(min_long), float(min_lat),
+                                float(max_long), float(max_lat))
         return bound_box
 
     def get_points_list(self):
@@ -271,27 +435,45 @@ class GeocodedLocation(object):
 
     def get_diag_buffer(self):
         """Get the approximate distance (in km) of the bounding box diagonal."""
-        diag_dist = self.calc_haversine_distance(a_long = self.bound_box.min_x,
-                                                 a_lat = self.bound_box.min_y,
-                                                 b_long = self.bound_box.max_x,
-                                                 b_lat = self.bound_box.max_y)
-        return diag_dist
+        if self.diag_buffer is None:
+            self.diag_buffer = self.calc_haversine_distance(
+                a_long = self.bound_box.min_x,
+                a_lat = self.bound_box.min_y,
+                b_long = self.bound_box.max_x,
+                b_lat = self.bound_box.max_y
+            )
+        return self.diag_buffer
+
+    def get_attribute_values(self):
+        """Return all relevant attributes as a tuple of scalars, in the order
+        of `LOCATION_FIELDS`."""
+        centroid = self.get_centroid()
+        return (
+            self.address_name,
+            self.location_type,
+            centroid[0],
+            centroid[1],
+            self.bound_box.max_y,
+            self.bound_box.min_y,
+            self.bound_box.max_x,
+            self.bound_box.min_x,
+            self.get_diag_buffer()
+        )
+
+    def get_attributes_as_dict(self):
+        """Return all relevant attributes as a dictionary of scalars."""
+        return dict(zip(LOCATION_FIELDS, self.get_attribute_values()))
 
     def get_attributes_as_series(self):
         """Return all relevant attributes as a pandas Series object."""
-        centroid = self.get_centroid()
-        buffer_dist = self.get_diag_buffer()
-        series_index = ['name','type','long','lat','bb_n','bb_s','bb_e','bb_w',
-                        'buffer']
-        series_vals = [
-            self.address_name, self.location_type, centroid[0], centroid[1], 
-            self.bound_box.max_y, self.bound_box.min_y, self.bound_box.max_x,
-            self.bound_box.min_x, buffer_dist]
-        return pd.Series(series_vals, index=series_index)
+        return pd.Series(self.get_attributes_as_dict())
 
 
 class WebInterface(object):
-    def __init__(self, location_text, iso=None, key=None, n_results=2):
+    app_name = None
+
+    def __init__(self, location_text, iso=None, key=None, n_results=2,
+                 session=None):
         """This class is a parent class for all individual web geocoding tools.
         Given location text and optional arguments (including an API key for 
         some geocoding tools), construct a web query for the tool, recover text 
@@ -305,34 +487,49 @@ class WebInterface(object):
                 This method is unique for each individual tool type.
             execute_query(): Execute the API query. This method populates the 
                 `output` attribute, and is the same across all tool types.
+            load_json_output(): Decode a JSON response, once per response.
+            is_cacheable(): Whether the response in `output` can be cached.
             populate_locs(): Given the text output from the web API query, 
                 populate valid GeocodingResult objects from the top two results.
                 This method is unique for each individual tool type.
             return_locs(): Return the `location_results` attribute.
 
         Attributes:
+            app_name (str): Short code for the web geocoding tool, used to look
+                up its concurrency limit. Set by each inherited class.
             location_text (str): Input text for geocoding.
             iso (str): Input ISO-2 code for geocoding. Only accepted by some
                 tools.
             key (str): API key or username. Only required for some tools.
             n_results (int): How many geocoding results should be populated?
+            session (requests.Session): Session used to execute the query. If
+                None, `default_session` is used.
             request_url (str): URL where the API query will be executed. This
                 attribute is filled by `build_query()`.
             request_params (dict): Dictionary containing all arguments in the 
                 API request "payload". This attribute is filled by 
                 `build_query()`.
-            output: API output object from the `requests` library. This object
-                is populated by the `execute_query()` method.
+            output (bytes): Raw response body from the API query, decoded
+                directly by the JSON or XML parser. This attribute is
+                populated by the `execute_query()` method.
+            parsed_output: The decoded JSON response, for tools that return
+                JSON. This attribute is populated by `load_json_output()`.
+            succeeded (bool): Whether the query received a usable response that
+                could be cached. This attribute is set by `execute_query()`.
             location_results: A list of up to two `GeocodedLocation` objects.
                 This attribute is populated by the `populate_locs()` method.
         """
         self.location_text = location_text
-        self.iso = iso
+        # Checked once here so that each `build_query()` only tests for None
+        self.iso = check_iso(iso)
         self.key = key
         self.n_results = n_results
+        self.session = session
         self.request_url = None # Initialized in `build_query()`
         self.request_params = None # Initialized in `build_query()`
         self.output = None # Initialized in `execute_query()`
+        self.parsed_output = None # Initialized in `load_json_output()`
+        self.succeeded = False # Set in `execute_query()`
         self.location_results = [] # Initialized in `populate_locs()`
 
     def build_query(self):
@@ -341,12 +538,40 @@ class WebInterface(object):
 
     def execute_query(self):
         """This method should be the same for every interface. Run a pre-defined
-        query with appropriate error handling."""
+        query with appropriate error handling. Responses already received for
+        the same URL and parameters are reused from `response_cache`."""
         # TODO add more sophisticated error handling
-        self.output = requests.get(
-            url = self.request_url,
-            params = self.request_params
-        )
+        cache_key = (self.request_url, tuple(sorted(self.request_params.items())))
+        self.output = response_cache.get(cache_key)
+        if self.output is not None:
+            self.succeeded = True
+            return
+        http = self.session if self.session is not None else default_session
+        with provider_semaphores[self.app_name]:
+            if self.app_name in provider_buckets:
+                provider_buckets[self.app_name].acquire()
+            response = http.get(
+                url = self.request_url,
+                params = self.request_params,
+                timeout = REQUEST_TIMEOUT
+            )
+        self.output = response.content
+        self.succeeded = response.ok and self.is_cacheable()
+        if self.succeeded:
+            response_cache.set(cache_key, self.output)
+
+    def load_json_output(self):
+        """Decode the JSON response body in `output`. The result is kept, so
+        `is_cacheable()` and `populate_locs()` share one parse."""
+        if self.parsed_output is None:
+            self.parsed_output = json_loads(self.output)
+        return self.parsed_output
+
+    def is_cacheable(self):
+        """Whether the response body in `output` can be reused for later
+        queries. Inherited classes override this to exclude error responses
+        that the tool returns with a success status code."""
+        return True
 
     def populate_locs(self):
         """This method will be different for every inherited class. Take JSON or
@@ -360,46 +585,58 @@ class WebInterface(object):
 
 class GMInterface(WebInterface):
     """This is the specific web interface used for Google Maps."""
+    app_name = 'GM'
+
     def build_query(self):
         self.request_url = 'https://maps.googleapis.com/maps/api/geocode/json'
         self.request_params = {
             'address' : self.location_text,
             'key'     : self.key
         }
-        if self.iso is not None and len(str(self.iso))==2:
+        if self.iso is not None:
             self.request_params['components'] = f"country:{self.iso}"
 
+    def is_cacheable(self):
+        # Quota and key errors are returned with a 200 status code
+        try:
+            return self.load_json_output().get('status') in ('OK', 'ZERO_RESULTS')
+        except ValueError:
+            return False
+
     def populate_locs(self):
-        output_dict = json.loads(self.output.text)
-        if 'results' in output_dict.keys():
-            response_list = output_dict['results']
-            num_locs = min([ len(response_list), self.n_results ])
-            for i in range(0, num_locs):
-                loc = response_list[i]
+        output_dict = self.load_json_output()
+        response_list = output_dict.get('results') or []
+        for loc in response_list[:self.n_results]:
+            geometry = loc.get('geometry') or {}
+            try:
+                bounds = geometry['bounds']
+                points_list = [
+                    [bounds['northeast']['lng'], bounds['northeast']['lat']],
+                    [bounds['southwest']['lng'], bounds['southwest']['lat']]
+                ]
+            except (KeyError, TypeError):
+                # Missing or partial bounds: use the point location, which has
+                #  no buffer
                 try:
-                    if 'bounds' in loc['geometry'].keys():
-                        bounds = loc['geometry']['bounds']
-                        points_list = [
-                            [bounds['northeast']['lng'], bounds['northeast']['lat']],
-                            [bounds['southwest']['lng'], bounds['southwest']['lat']]
-                        ]
-                    elif 'location' in loc['geometry'].keys():
-                        ll = loc['geometry']['location']
-                        points_list = [ [ll['lng'], ll['lat']] ]
-                    self.location_results.append(
-                        GeocodedLocation(
-                            points_list   = points_list,
-                            address_name  = loc['formatted_address'],
-                            location_type = ';'.join(loc['types']),
-                            source        = 'GM'
-                        )
-                    )
-                except KeyError:
-                    pass
+                    ll = geometry['location']
+                    points_list = [ [ll['lng'], ll['lat']] ]
+                except (KeyError, TypeError):
+                    # No usable coordinates for this result
+                    continue
+            self.location_results.append(
+                GeocodedLocation(
+                    points_list   = points_list,
+                    address_name  = loc.get('formatted_address', ''),
+                    location_type = ';'.join(loc.get('types', [])),
+                    source        = 'GM'
+                )
+            )
 
 
 class OSMInterface(WebInterface):
     """This is the specific web interface used for OpenStreetMap."""
+    app_name = 'OSM'
+
     def build_query(self):
         self.request_url = "http://nominatim.openstreetmap.org/search"
         self.request_params = {
@@ -416,18 +653,17 @@ class OSMInterface(WebInterface):
             return True
         try:
             loc_iso = loc_dict['address']['country_code']
-            locations_same = (loc_iso.lower() == str(self.iso).lower())
+            locations_same = (loc_iso.lower() == self.iso)
             return locations_same
         except KeyError:
             return keep_unsure
 
     def populate_locs(self):
-        response_list = json.loads(self.output.text)
-        # Keep only locations with the correct ISO code
-        response_list = [i for i in response_list if self.in_correct_country(i)]
-        num_locs = min([ len(response_list), self.n_results ])
-        for i in range(0, num_locs):
-            loc_dict = response_list[i]
+        response_list = self.load_json_output()
+        # Keep only locations with the correct ISO code, stopping once enough
+        #  have been found
+        matches = (i for i in response_list if self.in_correct_country(i))
+        for loc_dict in islice(matches, self.n_results):
             bb = [float(b) for b in loc_dict['boundingbox']]
             self.location_results.append(
                 GeocodedLocation(
@@ -441,20 +677,28 @@ class OSMInterface(WebInterface):
 
 class GNInterface(WebInterface):    
     """This is the specific web interface used for GeoNames."""
+    app_name = 'GN'
+
     def build_query(self):
         self.request_url = "http://api.geonames.org/searchJSON"
         self.request_params = {
             'q' : self.location_text,
             'username' : self.key
         }
-        if self.iso is not None and len(str(self.iso)) == 2:
-            self.request_params['country'] = self.iso        
+        if self.iso is not None:
+            self.request_params['country'] = self.iso
+
+    def is_cacheable(self):
+        # Errors, e.g. for an unknown username, have a status instead of results
+        try:
+            return 'geonames' in self.load_json_output()
+        except ValueError:
+            return False
+
     def populate_locs(self):
         try:
-            response_list = json.loads(self.output.text)['geonames']
-            num_locs = min([ len(response_list), self.n_results ])
-            for i in range(0, num_locs):
-                loc_dict = response_list[i]
+            response_list = self.load_json_output()['geonames']
+            for loc_dict in response_list[:self.n_results]:
                 self.location_results.append(
                     GeocodedLocation(
                         points_list   = [
@@ -471,6 +715,8 @@ class GNInterface(WebInterface):
 
 class FuzzyGInterface(WebInterface):
     """This is the specific web interface used for the FuzzyG geocoding tool."""
+    app_name = 'FG'
+
     def build_query(self):
         self.request_url = 'http://dma.jrc.it/fuzzyg/xml/'
         self.request_params = {
@@ -479,28 +725,20 @@ class FuzzyGInterface(WebInterface):
             'end'   : '2',
             'q'     : self.location_text
         }
-        if self.iso is not None and len(str(self.iso)) == 2:
+        if self.iso is not None:
             self.request_params['cc'] = self.iso.upper() # ISO2 must be uppercase
 
     def populate_locs(self):
-        output_dict = xmltodict.parse(self.output.text)
-        if output_dict['fuzzyg']['response']['results'] is not None:
-            response_list = output_dict['fuzzyg']['response']['results']['result']
-            if isinstance(response_list, OrderedDict):
-                # There is only one result
-                num_locs = 1
-                response_list = [response_list]
-            else:
-                num_locs = min([ len(response_list), self.n_results ])
-            for i in range(0, num_locs):
-                loc_dict = response_list[i]
-                self.location_results.append(
-                    GeocodedLocation(
-                        points_list = [
-                            [float(loc_dict['ddlong']), float(loc_dict['ddlat'])]
-                        ],
-                        address_name = loc_dict['fullname'],
-                        location_type = loc_dict['dsg']['#text'],
-                        source = 'FuzzyG'
-                    )
-                )
\ No newline at end of file
+        root = ElementTree.fromstring(self.output)
+        response_list = root.findall('./response/results/result')
+        for loc in response_list[:self.n_results]:
+            self.location_results.append(
+                GeocodedLocation(
+                    points_list = [
+                        [float(loc.findtext('ddlong')), float(loc.findtext('ddlat'))]
+                    ],
+                    address_name = loc.findtext('fullname'),
+                    location_type = loc.findtext('dsg'),
+                    source = 'FuzzyG'
+                )
+            )
\ No newline at end of file
@@ -8,29 +8,63 @@ This file defines common utilies for file I/O in Pandas
 
 Written in Python 3.6
 """
-import numpy as np
+import chardet
+import codecs
 import pandas as pd
-from encodings.aliases import aliases
-import json
-import re
-import csv
 import os
-from io import StringIO
+import time
+from io import BytesIO
+from openpyxl import Workbook
+try:
+    import pyarrow as pa
+except ImportError:
+    # pyarrow is optional; CSVs are read with pandas' own parser if it is
+    #  unavailable
+    pa = None
+# Arrow-backed strings are stored contiguously, without a Python object per row
+STRING_DTYPE = 'string[pyarrow]' if pa is not None else 'string'
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 
 
 def write_pandas(df, fp, encoding):
     """Write a pandas DataFrame to a CSV or Excel file using a known file
-    encoding."""
+    encoding. Excel files are always UTF-8, so `encoding` only applies to
+    CSVs."""
     try:
         if fp.lower().endswith('.csv'):
-            df.to_csv(fp, encoding=encoding, index=False)
+            write_csv(df, fp, encoding=encoding)
         else:
-            df.to_excel(fp, encoding=encoding, index=False)
+            write_excel(df, fp)
         return None
     except Exception as e:
         return e
 
 
+def write_excel(df, fp):
+    """Write a pandas DataFrame to an Excel file using openpyxl's write-only
+    mode, which streams rows to disk rather than building the whole workbook
+    in memory first."""
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet()
+    ws.append([str(c) for c in df.columns])
+    # Excel has no representation for NaN, so write missing values as blanks
+    values = df.astype(object).where(df.notna(), None)
+    for row in values.itertuples(index=False, name=None):
+        ws.append(row)
+    wb.save(fp)
+
+
+def write_csv(df, sink, encoding='utf-8', header=True):
+    """Write a pandas DataFrame as CSV to a filepath or binary buffer. Output
+    is always formatted by `DataFrame.to_csv()`, so that every file (and
+    every chunk appended to one) has the same quoting and number formatting.
+    Set `header` to False when appending further rows to an open buffer."""
+    df.to_csv(sink, encoding=encoding, header=header, index=False)
+
+
 def get_geocoding_sources():
     '''Store a list of geocoding source types and related prefixes'''
     sources = {
@@ -39,30 +73,24 @@ def get_geocoding_sources():
     return sources
 
 
+# Suffixes of the fields kept from each geocoding result, in output order
+GEOCODING_SUFFIXES = ('name','type','lat','long','buffer')
+
+
 def get_geocoding_suffixes():
     """Store a list of suffixes that should be included in geocoding fields"""
-    suffixes_list = ['name','type','lat','long','buffer']
-    return suffixes_list
+    return list(GEOCODING_SUFFIXES)
 
 
 def json_to_dataframe(json_data):
-    """Get the json passed from vet save form and process into excel-saveable format"""
-    null = None
-    json_data = eval(json_data)
-    keys = json_data.keys()
-    column_names = list(json_data[list(keys)[0]].keys())
-    column_names.insert(0, "address")
-    del column_names[-1]
-
-    csv_list = list()
-    for key in keys:
-        row_list = list(json_data[key].values())
-        row_list.insert(0, key)
-        del row_list[-1]
-        row_list[0] = re.sub('\d: ','', row_list[0])
-        csv_list.append(row_list)
-
-    df = pd.DataFrame(csv_list, columns=column_names)
+    """Get the json passed from vet save form and process into excel-saveable format.
+    `json_data` may be str or UTF-8 bytes; it is parsed with orjson if installed."""
+    json_data = json_loads(json_data)
+    df = pd.DataFrame.from_dict(json_data, orient='index')
+    df = df.drop(columns='__index', errors='ignore')
+    # Strip the "<index>: " prefix added to each address before vetting
+    df.insert(0, 'address', df.index.str.replace(r'^\d+: ', '', regex=True))
+    df = df.reset_index(drop=True)
     return(df)
 
 def safe_save_vet_output(df, filepath):
@@ -82,9 +110,8 @@ def safe_save_vet_output(df, filepath):
          return("specified directory does not exist")
 
 
-def validate_iso2(iso2_list):
-    """check that the iso2 values passed in for geocoding are valid"""
-    valid_iso2_set = ["AF", "AX", "AL", "DZ", "AS", "AD", "AO", "AI", "AQ", "AG", 
+# All officially assigned ISO 3166-1 alpha-2 codes
+VALID_ISO2 = frozenset(["AF", "AX", "AL", "DZ", "AS", "AD", "AO", "AI", "AQ", "AG", 
         "AR", "AM", "AW", "AU", "AT", "AZ", "BH", "BS", "BD", "BB", "BY", "BE", "BZ",
         "BJ", "BM", "BT", "BO", "BQ", "BA", "BW", "BV", "BR", "IO", "BN", "BG", "BF",
         "BI", "KH", "CM", "CA", "CV", "KY", "CF", "TD", "CL", "CN", "CX", "CC", "CO", 
@@ -103,19 +130,19 @@ def validate_iso2(iso2_list):
         "ZA", "GS", "SS", "ES", "LK", "SD", "SR", "SJ", "SZ", "SE", "CH", "SY", "TW", 
         "TJ", "TZ", "TH", "TL", "TG", "TK", "TO", "TT", "TN", "TR", "TM", "TC", "TV", 
         "UG", "UA", "AE", "GB", "US", "UM", "UY", "UZ", "VU", "VE", "VN", "VG", "VI", 
-        "WF", "EH", "YE", "ZM", "ZW"]
-    iso2_set = [element.upper() for element in list(iso2_list.unique())]
-    valid_iso2 = all(x in valid_iso2_set for x in iso2_set)
+        "WF", "EH", "YE", "ZM", "ZW"])
+
 
-    if valid_iso2:
+def validate_iso2(iso2_list):
+    """check that the iso2 values passed in for geocoding are valid"""
+    # Each distinct code only needs to be checked once
+    iso2_set = pd.Series(iso2_list.dropna().unique()).astype(str).str.upper()
+    bad_iso2s = list(iso2_set[~iso2_set.isin(VALID_ISO2)].unique())
+
+    if not bad_iso2s:
         return None
     else:
-        bad_iso2s = [item for item in iso2_set if item not in valid_iso2_set]
-        if(len(bad_iso2s) > 1):
-            bad_iso2s = ", ".join(bad_iso2s)
-        else:
-            bad_iso2s = bad_iso2s[0]
-        return bad_iso2s
+        return ", ".join(bad_iso2s)
 
 
 def check_keys_for_tools(keygm, geonames, usetools):
@@ -128,21 +155,87 @@ def check_keys_for_tools(keygm, geonames, usetools):
             return "Geonames has been specified as a service, a Geonames username must be provided."
 
 
-def read_and_prep_input(f, encoding) :
-    
-    encoding_list = [encoding] + ['utf-8', 'latin-1']
+# Byte order marks, checked longest first since the UTF-32-LE mark starts with
+#  the UTF-16-LE mark
+BYTE_ORDER_MARKS = (
+    (codecs.BOM_UTF32_LE, 'utf-32'), (codecs.BOM_UTF32_BE, 'utf-32'),
+    (codecs.BOM_UTF8, 'utf-8-sig'),
+    (codecs.BOM_UTF16_LE, 'utf-16'), (codecs.BOM_UTF16_BE, 'utf-16'),
+)
+
+
+def sniff_encodings(stream, sample_size=65536, min_confidence=0.8):
+    """Get the encodings to try for a binary stream, most likely first: the
+    encoding named by its byte order mark, if it has one; strict UTF-8; the
+    encoding guessed from its first `sample_size` bytes, only if the guess is
+    confident; and finally latin-1. Single-byte encodings decode any bytes, so
+    a wrong guess would never fail over to the next encoding and would
+    silently garble the text instead (e.g. "Göttingen" read as cp865)."""
+    stream.seek(0)
+    sample = stream.read(sample_size)
+    stream.seek(0)
+    encodings = [bom_encoding for bom, bom_encoding in BYTE_ORDER_MARKS
+                 if sample.startswith(bom)][:1]
+    encodings.append('utf-8')
+    guess = chardet.detect(sample)
+    if guess['encoding'] is not None and guess['confidence'] >= min_confidence:
+        encodings.append(guess['encoding'])
+    encodings.append('latin-1')
+    return candidate_encodings(*encodings)
+
+
+def candidate_encodings(*encodings):
+    """Get a list of encodings to try in order, skipping unknown names and
+    aliases of an encoding already in the list (e.g. 'utf8' after 'utf-8')."""
+    candidates = dict()
+    for encoding in encodings:
+        try:
+            candidates.setdefault(codecs.lookup(encoding).name, encoding)
+        except (LookupError, TypeError):
+            pass
+    return list(candidates.values())
+
+
+def decodes_cleanly(fp, encoding, block_size=1048576):
+    """Check whether the whole file at `fp` can be decoded with `encoding`.
+    The file is decoded in blocks, so memory use does not grow with the file
+    size."""
+    decoder = codecs.getincrementaldecoder(encoding)()
+    try:
+        with open(fp, 'rb') as f:
+            for block in iter(lambda: f.read(block_size), b''):
+                decoder.decode(block)
+            decoder.decode(b'', final=True)
+    except UnicodeDecodeError:
+        return False
+    return True
+
+
+def read_and_prep_input(f, encoding, use_pyarrow=False) :
+    """Read an uploaded CSV into a pandas DataFrame. The upload stream is
+    handed straight to the pandas parser, which decodes it in C rather than
+    building a decoded copy of the whole file in Python first. If
+    `use_pyarrow` is True and pyarrow is installed, the file is parsed with
+    pyarrow's multithreaded reader, except for the final latin-1 retry."""
+    # Werkzeug FileStorage objects wrap the spooled upload in `stream`
+    stream = getattr(f, 'stream', f)
+    encoding_list = [] if encoding in (None, '', 'detect') else [encoding]
+    # Try the given encoding first, then the sniffed ones, without repeats
+    encoding_list = candidate_encodings(*encoding_list, *sniff_encodings(stream))
+    use_pyarrow = use_pyarrow and pa is not None
+    read_errors = (UnicodeDecodeError, LookupError)
+    if use_pyarrow:
+        read_errors = read_errors + (pa.ArrowInvalid,)
 
     valid_encoding = None
     for test_encoding in encoding_list:
+        engine = 'pyarrow' if use_pyarrow and test_encoding != 'latin-1' else 'c'
         try:
-            f.seek(0)
-            csv_file = f.read().decode(test_encoding)
-            f.close()
-            csv_file = StringIO(csv_file)
-            df = pd.read_csv(csv_file, encoding=test_encoding)
+            stream.seek(0)
+            df = pd.read_csv(stream, encoding=test_encoding, engine=engine)
             valid_encoding = test_encoding
             return df, valid_encoding, None
-        except (UnicodeDecodeError, LookupError) as e:
+        except read_errors as e:
             pass
 
     if valid_encoding is None:
@@ -150,11 +243,27 @@ def read_and_prep_input(f, encoding) :
     return None, None, "You should never see this"
 
 
-def prep_stringio_output(df):
+def remove_old_files(directory, max_age):
+    """Delete files in a directory that were last modified more than
+    `max_age` seconds ago."""
+    cutoff = time.time() - max_age
+    for entry in os.scandir(directory):
+        try:
+            if entry.is_file() and entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+        except OSError:
+            # The file may have been removed by another worker
+            pass
+
+
+def prep_bytesio_output(df):
+    """Write a DataFrame as UTF-8 CSV into an in-memory binary buffer that can
+    be sent to the browser as-is, without a separate encoding step."""
     try:
-        string_buffer = StringIO()
-        df.to_csv(string_buffer, index=False)
-        return string_buffer, None
+        bytes_buffer = BytesIO()
+        write_csv(df, bytes_buffer)
+        bytes_buffer.seek(0)
+        return bytes_buffer, None
     except Exception as e:
         return None, e
 
@@ -167,31 +276,73 @@ def validate_columns(df, iso, address):
     return None
 
 
-def read_to_pandas(fp, encoding='detect'):
-    """Read an input Excel or CSV file as a pandas DataFrame, testing a variety
-    of encodings."""
+def set_input_dtypes(df, address=None, iso=None):
+    """Store the address column with pandas' string dtype and the ISO-2 column
+    as a category, rather than as generic Python objects. Each ISO code is then
+    stored once, with a small integer code per row. Addresses are backed by an
+    Arrow string array when pyarrow is installed."""
+    dtypes = {address: STRING_DTYPE, iso: 'category'}
+    dtypes = {col: dtype for col, dtype in dtypes.items() if col in df.columns}
+    if dtypes:
+        df = df.astype(dtypes)
+    return df
+
+
+def iter_csv_chunks(fp, encoding='detect', chunksize=200000, address=None,
+                    iso=None):
+    """Read an input CSV file as a sequence of DataFrames of at most
+    `chunksize` rows, so that only one chunk needs to be held in memory at a
+    time. Returns a (chunk iterator, encoding) tuple. The encoding is checked
+    against the whole file before any chunk is read, so that a decoding error
+    cannot stop a run partway through; the passed encoding, if any, is tried
+    first, then those from `sniff_encodings()`, as in `read_to_pandas()`."""
+    encoding_list = [] if encoding in (None, '', 'detect') else [encoding]
+    with open(fp, 'rb') as f:
+        encoding_list = candidate_encodings(*encoding_list, *sniff_encodings(f))
+    # latin-1 decodes any byte sequence, so one of these always succeeds
+    for test_encoding in encoding_list:
+        if decodes_cleanly(fp, test_encoding):
+            encoding = test_encoding
+            break
+        if test_encoding == encoding:
+            print(f"The file {fp} could not be opened with encoding {encoding}.")
+            print("Testing out other character encodings now...")
+    chunks = (
+        set_input_dtypes(chunk, address, iso)
+        for chunk in pd.read_csv(fp, encoding=encoding, chunksize=chunksize)
+    )
+    return (chunks, encoding)
+
+
+def read_to_pandas(fp, encoding='detect', address=None, iso=None):
+    """Read an input Excel or CSV file as a pandas DataFrame. If the encoding
+    of a CSV file is not passed, or the passed encoding fails, the encodings
+    from `sniff_encodings()` are tried in order. Excel files store their own
+    encoding. CSVs are parsed with pandas' C parser, the same as
+    `iter_csv_chunks()`, so pass-through columns are written back unchanged
+    whichever path reads them. The `address` and `iso` columns, if given, are
+    converted with `set_input_dtypes()`."""
     try:
-        readfun = pd.read_csv if fp.lower().endswith('.csv') else pd.read_excel
-        if encoding != 'detect':
-            # Try to read using the passed encoding
-            try:
-                df = readfun(fp, encoding=encoding)
-                return (df, encoding, None)
-            except Exception as e:
-                print(f"The file {fp} could not be opened with encoding {encoding}.")
-                print("Testing out all valid character encodings now...")
-        # If the 
-        test_encodings = ['utf-8','latin1'] + list(aliases.keys())
-        valid_encoding = None
-        for test_encoding in test_encodings:
+        if not fp.lower().endswith('.csv'):
+            df = set_input_dtypes(pd.read_excel(fp), address, iso)
+            return (df, 'utf-8', None)
+        read_errors = (UnicodeDecodeError, LookupError)
+        if encoding in (None, '', 'detect'):
+            encoding_list = []
+        else:
+            encoding_list = [encoding]
+        with open(fp, 'rb') as f:
+            # Try each encoding once, in order; latin-1 decodes any byte sequence
+            encoding_list = candidate_encodings(*encoding_list, *sniff_encodings(f))
+        for test_encoding in encoding_list:
             try:
-                df = readfun(fp, encoding=test_encoding)
-                valid_encoding = test_encoding
-            except UnicodeDecodeError:
-                pass
-        if valid_encoding is None:
-            return(None, None, UnicodeDecodeError(encoding='All standard encodings', reason='', 
-                object=f'file {fp}', start=0, end=0))
-        return (df, valid_encoding, None)
+                df = pd.read_csv(fp, encoding=test_encoding)
+                return (set_input_dtypes(df, address, iso), test_encoding, None)
+            except read_errors:
+                if test_encoding == encoding:
+                    print(f"The file {fp} could not be opened with encoding {encoding}.")
+                    print("Testing out other character encodings now...")
+        return(None, None, UnicodeDecodeError(', '.join(encoding_list), b'', 0, 0,
+            f'file {fp} could not be decoded'))
     except Exception as e:
         return(None, None, e)
\ No newline at end of file
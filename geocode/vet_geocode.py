@@ -34,7 +34,9 @@ class VettingData(object):
 
     def load_data(self):
 
-        in_df, self.encoding, error = read_and_prep_input(self.in_fp, self.encoding)
+        in_df, self.encoding, error = read_and_prep_input(
+            self.in_fp, self.encoding, use_pyarrow=True
+        )
         '''Load input file as a dataframe'''
         #in_df, self.encoding, error = read_to_pandas(fp=self.in_fp, encoding=self.encoding)
 
@@ -72,7 +74,7 @@ class VettingData(object):
         if self.address_col != 'address':
             gc_data = gc_data.rename({self.address_col:'address'}, axis=1)
         # Update the address field so that it includes the index
-        gc_data['address'] = gc_data['__index'].apply(str).str.cat(
+        gc_data['address'] = gc_data['__index'].astype(str).str.cat(
             gc_data['address'], sep=': '
         )
         gc_data = gc_data.set_index(keys='address')